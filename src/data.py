@@ -1,4 +1,6 @@
+import os
 import random
+from hashlib import blake2b
 from pathlib import Path
 from typing import Any, Dict, Optional, Tuple
 
@@ -54,6 +56,41 @@ def create_cityscapes_colormap():
     return np.array(colors)
 
 
+def list_dir_cached(root, directory):
+    """Lists the sorted entry names of a directory.
+    The listing is cached in root/manifests, keyed on a hash of the resolved
+    directory path, and rebuilt whenever the directory's mtime or size
+    changes. If the cache can't be written (e.g. a read-only data mount) the
+    fresh listing is returned uncached.
+    """
+    directory = Path(directory).resolve()
+    stat = directory.stat()
+    key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    path_hash = blake2b(str(directory).encode("utf-8"), digest_size=16).hexdigest()
+    manifest_file = Path(root) / "manifests" / f"{path_hash}.npz"
+
+    if manifest_file.exists():
+        with np.load(manifest_file) as loaded:
+            if np.array_equal(loaded["key"], key):
+                return loaded["names"].tolist()
+
+    with os.scandir(directory) as entries:
+        names = sorted(entry.name for entry in entries)
+
+    tmp_file = manifest_file.with_name(f"{path_hash}.{os.getpid()}.tmp.npz")
+    try:
+        manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(tmp_file, names=np.array(names, dtype=str), key=key)
+        os.replace(tmp_file, manifest_file)
+    except OSError:
+        # e.g. a read-only data mount: skip caching and use the fresh listing
+        try:
+            tmp_file.unlink(missing_ok=True)
+        except OSError:
+            pass
+    return names
+
+
 class DirectoryDataset(Dataset):
     def __init__(self, root, path, image_set, transform, target_transform):
         super().__init__()
@@ -65,10 +102,10 @@ class DirectoryDataset(Dataset):
         self.transform = transform
         self.target_transform = target_transform
 
-        self.img_files = np.array(sorted(self.img_dir.iterdir()))
+        self.img_files = np.array(list_dir_cached(root, self.img_dir))
         assert len(self.img_files) > 0
         if (self.dir / "labels").exists():
-            self.label_files = np.array(sorted(self.label_dir.iterdir()))
+            self.label_files = np.array(list_dir_cached(root, self.label_dir))
             assert len(self.img_files) == len(self.label_files)
         else:
             self.label_files = None
@@ -407,8 +444,8 @@ class CroppedDataset(Dataset):
         self.target_transform = target_transform
         self.img_dir = self.root / "img" / self.split
         self.label_dir = self.root / "label" / self.split
-        self.num_images = len(list(self.img_dir.iterdir()))
-        assert self.num_images == len(list(self.label_dir.iterdir()))
+        self.num_images = len(list_dir_cached(root, self.img_dir))
+        assert self.num_images == len(list_dir_cached(root, self.label_dir))
 
     def __getitem__(self, index):
         image = Image.open(self.img_dir / f"{index}.jpg").convert("RGB")
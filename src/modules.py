@@ -331,17 +331,21 @@ def tensor_correlation(a, b):
     return torch.einsum("nchw,ncij->nhwij", a, b)
 
 
-def sample(t: torch.Tensor, coords: torch.Tensor):
+def sample(t: torch.Tensor, coords: torch.Tensor, mode: str = "bilinear"):
     return F.grid_sample(
-        t, coords.permute(0, 2, 1, 3), padding_mode="border", align_corners=True
+        t,
+        coords.permute(0, 2, 1, 3),
+        mode=mode,
+        padding_mode="border",
+        align_corners=True,
     )
 
 
 @torch.jit.script
 def super_perm(size: int, device: torch.device):
     perm = torch.randperm(size, device=device, dtype=torch.long)
-    perm[perm == torch.arange(size, device=device)] += 1
-    return perm % size
+    fixed = perm == torch.arange(size, device=device)
+    return torch.where(fixed, (perm + 1) % size, perm)
 
 
 def sample_nonzero_locations(t, target_size):
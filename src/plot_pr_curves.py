@@ -12,9 +12,13 @@ from lightning_fabric.utilities.seed import seed_everything
 from omegaconf import DictConfig, OmegaConf
 from pytorch_lightning import Trainer
 from pytorch_lightning.loggers import TensorBoardLogger
-from sklearn.metrics import auc, average_precision_score, precision_recall_curve
+from sklearn.metrics import auc
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard.summary import hparams
+from torchmetrics.functional.classification import (
+    binary_average_precision,
+    binary_precision_recall_curve,
+)
 from torchvision.transforms import ToTensor
 
 from data import (
@@ -30,35 +34,66 @@ from utils import UnsupervisedMetrics, get_transform, load_model, prep_args
 @torch.jit.script
 def super_perm(size: int, device: torch.device):
     perm = torch.randperm(size, device=device, dtype=torch.long)
-    perm[perm == torch.arange(size, device=device)] += 1
-    return perm % size
+    fixed = perm == torch.arange(size, device=device)
+    return torch.where(fixed, (perm + 1) % size, perm)
 
 
 def prep_fd_coord(fd):
-    fd -= fd.mean([3, 4], keepdim=True)
-    fd /= fd.std([3, 4], keepdim=True)
+    std, mean = torch.std_mean(fd, [3, 4], keepdim=True)
+    fd.sub_(mean).div_(std)
     return fd.reshape(-1)
 
 
 def prep_fd(fd):
-    fd -= fd.min()
-    fd /= fd.max()
+    fd_min, fd_max = torch.aminmax(fd)
+    fd.sub_(fd_min).div_(fd_max - fd_min)
     return fd.reshape(-1)
 
 
 def prep_fd_2(fd):
     fd -= fd.mean([3, 4], keepdim=True)
-    fd -= fd.min()
-    fd /= fd.max()
+    fd_min, fd_max = torch.aminmax(fd)
+    fd.sub_(fd_min).div_(fd_max - fd_min)
     return fd
 
 
+@torch.jit.script
+def pairwise_sq_dist(a: torch.Tensor, b: torch.Tensor):
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, so the cross term is a single bmm
+    # instead of a broadcast (n, S, T, c) difference tensor
+    sq_norms = a.square().sum(-1, keepdim=True) + b.square().sum(-1).unsqueeze(1)
+    return torch.baddbmm(sq_norms, a, b.transpose(1, 2), alpha=-2).clamp_min_(0)
+
+
 def plot_auc_raw(name, fpr, tpr):
-    fpr, tpr = fpr.detach().cpu().squeeze(), tpr.detach().cpu().squeeze()
+    # one stacked copy so a GPU curve costs a single device-to-host sync
+    fpr, tpr = torch.stack([fpr.reshape(-1), tpr.reshape(-1)]).detach().cpu()
     roc_auc = auc(fpr, tpr)
     plt.plot(fpr, tpr, label=name + " AUC = %0.2f" % roc_auc)
 
 
+@torch.jit.script
+def crf_potential(
+    coord_diff: torch.Tensor,
+    img_diff: torch.Tensor,
+    w1: torch.Tensor,
+    w2: torch.Tensor,
+    shift: torch.Tensor,
+    alpha: torch.Tensor,
+    beta: torch.Tensor,
+    gamma: torch.Tensor,
+):
+    # scripted so the fuser can run the elementwise chain as a single kernel
+    return (
+        torch.abs(w1)
+        * torch.exp(
+            -coord_diff / (2 * torch.exp(alpha)) - img_diff / (2 * torch.exp(beta))
+        )
+        + torch.abs(w2) * torch.exp(-coord_diff / (2 * torch.exp(gamma)))
+        - shift
+    )
+
+
 class CRFModule(torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -70,14 +105,15 @@ class CRFModule(torch.nn.Module):
         self.gamma = torch.nn.Parameter(torch.tensor(0.05), requires_grad=True)
 
     def forward(self, coord_diff, img_diff):
-        return (
-            torch.abs(self.w1)
-            * torch.exp(
-                -coord_diff / (2 * torch.exp(self.alpha))
-                - img_diff / (2 * torch.exp(self.beta))
-            )
-            + torch.abs(self.w2) * torch.exp(-coord_diff / (2 * torch.exp(self.gamma)))
-            - self.shift
+        return crf_potential(
+            coord_diff,
+            img_diff,
+            self.w1,
+            self.w2,
+            self.shift,
+            self.alpha,
+            self.beta,
+            self.gamma,
         )
 
 
@@ -122,50 +158,42 @@ class LitRecalibrator(pl.LightningModule):
         with torch.no_grad():
             n = img.shape[0]
             [h1, w1, h2, w2] = [self.cfg.train.feature_samples] * 4
-            img_samples_1 = (
-                sample(img, coords1).permute(0, 2, 3, 1).reshape(n, -1, 1, 3)
-            )
-            img_samples_2 = (
-                sample(img, coords2).permute(0, 2, 3, 1).reshape(n, 1, -1, 3)
-            )
-            coord_diff = (
-                (coords1.reshape(n, -1, 1, 2) - coords2.reshape(n, 1, -1, 2))
-                .square()
-                .sum(-1)
-                .reshape(n, h1, w1, h2, w2)
-            )
-
-            img_diff = (
-                (img_samples_1 - img_samples_2)
-                .square()
-                .sum(-1)
-                .reshape(n, h1, w1, h2, w2)
+            img_samples_1 = sample(img, coords1).permute(0, 2, 3, 1).reshape(n, -1, 3)
+            img_samples_2 = sample(img, coords2).permute(0, 2, 3, 1).reshape(n, -1, 3)
+            coord_diff = pairwise_sq_dist(
+                coords1.reshape(n, -1, 2), coords2.reshape(n, -1, 2)
+            ).reshape(n, h1, w1, h2, w2)
+            img_diff = pairwise_sq_dist(img_samples_1, img_samples_2).reshape(
+                n, h1, w1, h2, w2
             )
 
             return self.crf(coord_diff, img_diff)
 
-    def get_net_fd(self, feats1, feats2, label1, label2, coords1, coords2):
+    def sample_one_hot(self, label, coords):
+        # sample the label map first so the one-hot only covers the sampled points
+        sampled = sample(label.unsqueeze(1).to(torch.float), coords, mode="nearest")
+        sampled = sampled.squeeze(1).to(torch.int64)
+        return (
+            F.one_hot(sampled + 1, self.n_classes + 1)
+            .to(torch.float)
+            .permute(0, 3, 1, 2)
+        )
+
+    def get_label_fd(self, label1, label2, coords1, coords2):
         with torch.no_grad():
-            feat_samples1 = sample(feats1, coords1)
-            feat_samples2 = sample(feats2, coords2)
+            label_samples1 = self.sample_one_hot(label1, coords1)
+            label_samples2 = self.sample_one_hot(label2, coords2)
+            ld = tensor_correlation(label_samples1, label_samples2)
 
-            label_samples1 = sample(
-                F.one_hot(label1 + 1, self.n_classes + 1)
-                .to(torch.float)
-                .permute(0, 3, 1, 2),
-                coords1,
-            )
-            label_samples2 = sample(
-                F.one_hot(label2 + 1, self.n_classes + 1)
-                .to(torch.float)
-                .permute(0, 3, 1, 2),
-                coords2,
-            )
+        return ld, label_samples1.argmax(1), label_samples2.argmax(1)
 
+    def get_net_fd(self, feats1, feats2, coords1, coords2):
+        with torch.no_grad():
+            feat_samples1 = sample(feats1, coords1)
+            feat_samples2 = sample(feats2, coords2)
             fd = tensor_correlation(norm(feat_samples1), norm(feat_samples2))
-            ld = tensor_correlation(label_samples1, label_samples2)
 
-        return ld, fd, label_samples1.argmax(1), label_samples2.argmax(1)
+        return fd
 
     def training_step(self, batch, batch_idx):
         return None
@@ -189,15 +217,10 @@ class LitRecalibrator(pl.LightningModule):
 
             crf_fd = self.get_crf_fd(img, coords1, coords2)
 
-            ld, stego_fd, l1, l2 = self.get_net_fd(
-                dino_code, dino_code, label, label, coords1, coords2
-            )
-            ld, dino_fd, l1, l2 = self.get_net_fd(
-                dino_feats, dino_feats, label, label, coords1, coords2
-            )
-            ld, moco_fd, l1, l2 = self.get_net_fd(
-                moco_feats, moco_feats, label, label, coords1, coords2
-            )
+            ld, l1, l2 = self.get_label_fd(label, label, coords1, coords2)
+            stego_fd = self.get_net_fd(dino_code, dino_code, coords1, coords2)
+            dino_fd = self.get_net_fd(dino_feats, dino_feats, coords1, coords2)
+            moco_fd = self.get_net_fd(moco_feats, moco_feats, coords1, coords2)
 
             return dict(
                 dino_fd=dino_fd,
@@ -216,12 +239,13 @@ class LitRecalibrator(pl.LightningModule):
             all_outputs[k] = t
 
         def plot_pr(preds, targets, name):
-            preds = preds.cpu().reshape(-1)
-            preds -= preds.min()
-            preds /= preds.max()
-            targets = targets.to(torch.int64).cpu().reshape(-1)
-            precisions, recalls, _ = precision_recall_curve(targets, preds)
-            average_precision = average_precision_score(targets, preds)
+            preds = preds.reshape(-1)
+            preds_min, preds_max = torch.aminmax(preds)
+            preds.sub_(preds_min).div_((preds_max - preds_min).clamp_min(1e-12))
+            targets = targets.to(torch.int64).reshape(-1)
+            precisions, recalls, _ = binary_precision_recall_curve(preds, targets)
+            average_precision = binary_average_precision(preds, targets).item()
+            recalls, precisions = torch.stack([recalls, precisions]).cpu()
             plt.plot(
                 recalls, precisions, label=f"AP={int(average_precision * 100)}% {name}"
             )
@@ -339,11 +363,14 @@ def my_app(cfg: DictConfig) -> None:
         res=cfg.train.res,
     )
 
+    loader_args = dict(num_workers=cfg.num_workers, pin_memory=True)
+    if cfg.num_workers > 0:
+        loader_args.update(persistent_workers=True, prefetch_factor=4)
     train_loader = DataLoader(
-        train_dataset, cfg.train.batch_size, shuffle=True, num_workers=cfg.num_workers
+        train_dataset, cfg.train.batch_size, shuffle=True, **loader_args
     )
     val_loader = DataLoader(
-        val_dataset, cfg.train.batch_size, shuffle=True, num_workers=cfg.num_workers
+        val_dataset, cfg.train.batch_size, shuffle=True, **loader_args
     )
 
     model = LitRecalibrator(train_dataset.n_classes, cfg)
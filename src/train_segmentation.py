@@ -650,12 +650,15 @@ def my_app(cfg: DictConfig) -> None:
     )
 
     # val_dataset = MaterializedDataset(val_dataset)
+    loader_args: Dict[str, Any] = dict(num_workers=cfg.num_workers, pin_memory=True)
+    if cfg.num_workers > 0:
+        # keep workers alive between epochs instead of respawning them
+        loader_args.update(persistent_workers=True, prefetch_factor=4)
     train_loader = DataLoader(
         train_dataset,
         cfg.train.batch_size,
         shuffle=True,
-        num_workers=cfg.num_workers,
-        pin_memory=True,
+        **loader_args,
     )
 
     if cfg.train.submitting_to_aml:
@@ -667,8 +670,7 @@ def my_app(cfg: DictConfig) -> None:
         val_dataset,
         val_batch_size,
         shuffle=False,
-        num_workers=cfg.num_workers,
-        pin_memory=True,
+        **loader_args,
     )
 
     model = LitUnsupervisedSegmenter(train_dataset.n_classes, cfg)